@@ -25,6 +25,7 @@ along with this program. If not, see <https://www.gnu.org/licenses/>.
 """
 
 import logging
+import sys
 
 from nw.core.tokenizer import Tokenizer
 from nw.constants import nwLabels, nwKeyWords, nwHtmlUnicode
@@ -44,10 +45,47 @@ class ToHtml(Tokenizer):
         self.cssStyles = True
         self.fullHTML  = []
 
+        # Running total of the fullHTML chunk sizes, updated as chunks
+        # are added so getFullResultSize doesn't have to re-scan them
+        self._fullLen  = 0
+
         # Internals
         self._trMap = {}
         self.setReplaceUnicode(False)
 
+        # Cache of decoded block style strings, since the same handful
+        # of style combinations repeat for every token
+        self._styleCache = {}
+
+        # Cache of header anchor strings, since the same line numbers
+        # come back every time a document is re-converted
+        self._anchorCache = {}
+
+        # Comment and synopsis templates depend only on genMode, so they
+        # are rebound in setPreview instead of checked on every call
+        self._tplSynopsis = "<p class='synopsis'><strong>Synopsis:</strong> %s</p>\n"
+        self._tplComment  = "<p class='comment'><strong>Comment:</strong> %s</p>\n"
+
+        # The in-text format tags are static, so we build both variants
+        # once instead of on every doConvert call. The tags are interned
+        # as they are inserted thousands of times per export.
+        self._htmlTagsPreview = { # HTML4 + CSS2
+            self.FMT_B_B : sys.intern("<b>"),
+            self.FMT_B_E : sys.intern("</b>"),
+            self.FMT_I_B : sys.intern("<i>"),
+            self.FMT_I_E : sys.intern("</i>"),
+            self.FMT_D_B : sys.intern("<span style='text-decoration: line-through;'>"),
+            self.FMT_D_E : sys.intern("</span>"),
+        }
+        self._htmlTagsExport = { # HTML5
+            self.FMT_B_B : sys.intern("<strong>"),
+            self.FMT_B_E : sys.intern("</strong>"),
+            self.FMT_I_B : sys.intern("<em>"),
+            self.FMT_I_E : sys.intern("</em>"),
+            self.FMT_D_B : sys.intern("<del>"),
+            self.FMT_D_E : sys.intern("</del>"),
+        }
+
         return
 
     ##
@@ -64,6 +102,9 @@ class ToHtml(Tokenizer):
         self.doComments = doComments
         self.doSynopsis = doSynopsis
 
+        self._tplSynopsis = "<p class='comment'><span class='synopsis'>Synopsis:</span> %s</p>\n"
+        self._tplComment  = "<p class='comment'>%s</p>\n"
+
         return
 
     def setStyles(self, cssStyles):
@@ -97,7 +138,7 @@ class ToHtml(Tokenizer):
     def getFullResultSize(self):
         """Return the size of the full HTML result.
         """
-        return sum([len(x) for x in self.fullHTML])
+        return self._fullLen
 
     def doPreProcessing(self):
         """Extend the auto-replace to also properly encode some unicode
@@ -112,23 +153,9 @@ class ToHtml(Tokenizer):
         to theResult.
         """
         if self.genMode == self.M_PREVIEW:
-            htmlTags = {     # HTML4 + CSS2
-                self.FMT_B_B : "<b>",
-                self.FMT_B_E : "</b>",
-                self.FMT_I_B : "<i>",
-                self.FMT_I_E : "</i>",
-                self.FMT_D_B : "<span style='text-decoration: line-through;'>",
-                self.FMT_D_E : "</span>",
-            }
+            htmlTags = self._htmlTagsPreview
         else:
-            htmlTags = {     # HTML5
-                self.FMT_B_B : "<strong>",
-                self.FMT_B_E : "</strong>",
-                self.FMT_I_B : "<em>",
-                self.FMT_I_E : "</em>",
-                self.FMT_D_B : "<del>",
-                self.FMT_D_E : "</del>",
-            }
+            htmlTags = self._htmlTagsExport
 
         if self.isNovel and self.genMode != self.M_PREVIEW:
             # For novel files for export, we bump the titles one level
@@ -146,49 +173,47 @@ class ToHtml(Tokenizer):
             h3 = "h3"
             h4 = "h4"
 
+        # Heading tag and class, mapped by token type
+        hLookup = {
+            self.T_TITLE : ("h1", " class='title'"),
+            self.T_HEAD1 : (h1, h1Cl),
+            self.T_HEAD2 : (h2, ""),
+            self.T_HEAD3 : (h3, ""),
+            self.T_HEAD4 : (h4, ""),
+        }
+
         self.theResult = ""
 
         thisPar = []
         parStyle = None
         tmpResult = []
+        tmpAppend = tmpResult.append
         hasHardBreak = False
 
+        # These settings are fixed for the duration of the call, so we
+        # read them once here instead of once per token
+        cssStyles   = self.cssStyles
+        linkHeaders = self.linkHeaders
+        doSynopsis  = self.doSynopsis
+        doComments  = self.doComments
+        doKeywords  = self.doKeywords
+
         for tType, tLine, tText, tFormat, tStyle in self.theTokens:
 
             # Styles
-            aStyle = []
-            if tStyle is not None and self.cssStyles:
-                if tStyle & self.A_LEFT:
-                    aStyle.append("text-align: left;")
-                elif tStyle & self.A_RIGHT:
-                    aStyle.append("text-align: right;")
-                elif tStyle & self.A_CENTRE:
-                    aStyle.append("text-align: center;")
-                elif tStyle & self.A_JUSTIFY:
-                    aStyle.append("text-align: justify;")
-
-                if tStyle & self.A_PBB:
-                    aStyle.append("page-break-before: always;")
-                elif tStyle & self.A_PBB_AUT:
-                    aStyle.append("page-break-before: auto;")
-
-                if tStyle & self.A_PBA:
-                    aStyle.append("page-break-after: always;")
-                elif tStyle & self.A_PBA_AUT:
-                    aStyle.append("page-break-after: auto;")
-
-                if tStyle & self.A_Z_BTMMRG:
-                    aStyle.append("margin-bottom: 0;")
-                if tStyle & self.A_Z_TOPMRG:
-                    aStyle.append("margin-top: 0;")
-
-            if len(aStyle) > 0:
-                hStyle = " style='%s'" % (" ".join(aStyle))
-            else:
+            if tStyle is None or not cssStyles:
                 hStyle = ""
-
-            if self.linkHeaders:
-                aNm = "<a name='T%06d'></a>" % tLine
+            else:
+                hStyle = self._styleCache.get(tStyle)
+                if hStyle is None:
+                    hStyle = self._decodeStyle(tStyle)
+                    self._styleCache[tStyle] = hStyle
+
+            if linkHeaders:
+                aNm = self._anchorCache.get(tLine)
+                if aNm is None:
+                    aNm = "<a name='T%06d'></a>" % tLine
+                    self._anchorCache[tLine] = aNm
             else:
                 aNm = ""
 
@@ -196,70 +221,72 @@ class ToHtml(Tokenizer):
             if tType == self.T_EMPTY:
                 if parStyle is None:
                     parStyle = ""
-                if hasHardBreak and self.cssStyles:
+                if hasHardBreak and cssStyles:
                     parClass = " class='break'"
                 else:
                     parClass = ""
-                if len(thisPar) > 0:
-                    tTemp = "".join(thisPar)
-                    tmpResult.append("<p%s%s>%s</p>\n" % (parStyle, parClass, tTemp.rstrip()))
+                if thisPar:
+                    # Trailing whitespace can only come from the last
+                    # fragment, so strip it there instead of re-copying
+                    # the joined paragraph
+                    thisPar[-1] = thisPar[-1].rstrip()
+                    tmpAppend(f"<p{parStyle}{parClass}>{''.join(thisPar)}</p>\n")
                 thisPar = []
                 parStyle = None
                 hasHardBreak = False
 
-            elif tType == self.T_TITLE:
-                tHead = tText.replace(r"\\", "<br/>")
-                tmpResult.append("<h1 class='title'%s>%s%s</h1>\n" % (hStyle, aNm, tHead))
-
-            elif tType == self.T_HEAD1:
-                tHead = tText.replace(r"\\", "<br/>")
-                tmpResult.append("<%s%s%s>%s%s</%s>\n" % (h1, h1Cl, hStyle, aNm, tHead, h1))
-
-            elif tType == self.T_HEAD2:
-                tHead = tText.replace(r"\\", "<br/>")
-                tmpResult.append("<%s%s>%s%s</%s>\n" % (h2, hStyle, aNm, tHead, h2))
-
-            elif tType == self.T_HEAD3:
-                tHead = tText.replace(r"\\", "<br/>")
-                tmpResult.append("<%s%s>%s%s</%s>\n" % (h3, hStyle, aNm, tHead, h3))
-
-            elif tType == self.T_HEAD4:
-                tHead = tText.replace(r"\\", "<br/>")
-                tmpResult.append("<%s%s>%s%s</%s>\n" % (h4, hStyle, aNm, tHead, h4))
-
-            elif tType == self.T_SEP:
-                tmpResult.append("<p class='sep'>%s</p>\n" % tText)
-
-            elif tType == self.T_SKIP:
-                tmpResult.append("<p class='skip'>&nbsp;</p>\n")
-
             elif tType == self.T_TEXT:
-                tTemp = tText
                 if parStyle is None:
                     parStyle = hStyle
-                for xPos, xLen, xFmt in reversed(tFormat):
-                    tTemp = tTemp[:xPos] + htmlTags[xFmt] + tTemp[xPos+xLen:]
+                if tFormat:
+                    # Insert the format tags in a single forward pass.
+                    # The format entries are sorted by position, so each
+                    # text slice is copied exactly once.
+                    tParts = []
+                    xEnd = 0
+                    for xPos, xLen, xFmt in tFormat:
+                        tParts.append(tText[xEnd:xPos])
+                        tParts.append(htmlTags[xFmt])
+                        xEnd = xPos + xLen
+                    tParts.append(tText[xEnd:])
+                    tTemp = "".join(tParts)
+                else:
+                    tTemp = tText
                 if tText.endswith("  "):
                     thisPar.append(tTemp.rstrip() + "<br/>")
                     hasHardBreak = True
                 else:
                     thisPar.append(tTemp.rstrip() + " ")
 
-            elif tType == self.T_SYNOPSIS and self.doSynopsis:
-                tmpResult.append(self._formatSynopsis(tText))
+            elif tType in hLookup:
+                hTag, hClass = hLookup[tType]
+                tHead = tText.replace(r"\\", "<br/>") if r"\\" in tText else tText
+                tmpAppend("<%s%s%s>%s%s</%s>\n" % (
+                    hTag, hClass, hStyle, aNm, tHead, hTag
+                ))
 
-            elif tType == self.T_COMMENT and self.doComments:
-                tmpResult.append(self._formatComments(tText))
+            elif tType == self.T_SEP:
+                tmpAppend("<p class='sep'>%s</p>\n" % tText)
+
+            elif tType == self.T_SKIP:
+                tmpAppend("<p class='skip'>&nbsp;</p>\n")
+
+            elif tType == self.T_SYNOPSIS and doSynopsis:
+                tmpAppend(self._formatSynopsis(tText))
+
+            elif tType == self.T_COMMENT and doComments:
+                tmpAppend(self._formatComments(tText))
 
-            elif tType == self.T_KEYWORD and self.doKeywords:
+            elif tType == self.T_KEYWORD and doKeywords:
                 tTemp = "<p%s>%s</p>\n" % (hStyle, self._formatKeywords(tText))
-                tmpResult.append(tTemp)
+                tmpAppend(tTemp)
 
         self.theResult = "".join(tmpResult)
         tmpResult = []
 
         if self.genMode != self.M_PREVIEW:
             self.fullHTML.append(self.theResult)
+            self._fullLen += len(self.theResult)
 
         return
 
@@ -269,10 +296,8 @@ class ToHtml(Tokenizer):
         with open(savePath, mode="w", encoding="utf8") as outFile:
             theStyle = self.getStyleSheet()
             theStyle.append("article {width: 800px; margin: 40px auto;}")
-            bodyText = "".join(self.fullHTML)
-            bodyText = bodyText.replace("\t", "&#09;").rstrip()
 
-            theHtml = (
+            outFile.write((
                 "<!DOCTYPE html>\n"
                 "<html>\n"
                 "<head>\n"
@@ -284,28 +309,43 @@ class ToHtml(Tokenizer):
                 "</style>\n"
                 "<body>\n"
                 "<article>\n"
-                "{bodyText:s}\n"
-                "</article>\n"
-                "</body>\n"
-                "</html>\n"
             ).format(
                 projTitle = self.theProject.projName,
                 htmlStyle = "\n".join(theStyle),
-                bodyText = bodyText,
+            ))
+
+            # Stream the body one chunk at a time instead of joining it
+            # into a single string, so peak memory stays bounded by the
+            # largest chunk. Trailing whitespace is stripped by dropping
+            # empty trailing chunks and rstripping the last one written.
+            lastIdx = len(self.fullHTML) - 1
+            while lastIdx >= 0 and not self.fullHTML[lastIdx].replace("\t", "&#09;").strip():
+                lastIdx -= 1
+
+            for i in range(lastIdx + 1):
+                aChunk = self.fullHTML[i].replace("\t", "&#09;")
+                if i == lastIdx:
+                    aChunk = aChunk.rstrip()
+                outFile.write(aChunk)
+
+            outFile.write(
+                "\n</article>\n"
+                "</body>\n"
+                "</html>\n"
             )
-            outFile.write(theHtml)
 
         return
 
     def replaceTabs(self, nSpaces=8, spaceChar="&nbsp;"):
         """Replace tabs with spaces in the html.
         """
-        htmlText = []
-        eightSpace = spaceChar*nSpaces
-        for aLine in self.fullHTML:
-            htmlText.append(aLine.replace("\t", eightSpace))
+        tabTrans = str.maketrans({"\t": spaceChar*nSpaces})
+        for i, aLine in enumerate(self.fullHTML):
+            self.fullHTML[i] = aLine.translate(tabTrans)
+
+        # The expansion changes the chunk sizes
+        self._fullLen = sum(map(len, self.fullHTML))
 
-        self.fullHTML = htmlText
         return
 
     def getStyleSheet(self):
@@ -402,21 +442,50 @@ class ToHtml(Tokenizer):
     #  Internal Functions
     ##
 
+    def _decodeStyle(self, tStyle):
+        """Decode a block style bitmask into a style attribute string.
+        Only called from doConvert, which checks for None and whether
+        css styles are enabled, and memoizes the result per bitmask.
+        """
+        aStyle = []
+        if tStyle & self.A_LEFT:
+            aStyle.append("text-align: left;")
+        elif tStyle & self.A_RIGHT:
+            aStyle.append("text-align: right;")
+        elif tStyle & self.A_CENTRE:
+            aStyle.append("text-align: center;")
+        elif tStyle & self.A_JUSTIFY:
+            aStyle.append("text-align: justify;")
+
+        if tStyle & self.A_PBB:
+            aStyle.append("page-break-before: always;")
+        elif tStyle & self.A_PBB_AUT:
+            aStyle.append("page-break-before: auto;")
+
+        if tStyle & self.A_PBA:
+            aStyle.append("page-break-after: always;")
+        elif tStyle & self.A_PBA_AUT:
+            aStyle.append("page-break-after: auto;")
+
+        if tStyle & self.A_Z_BTMMRG:
+            aStyle.append("margin-bottom: 0;")
+        if tStyle & self.A_Z_TOPMRG:
+            aStyle.append("margin-top: 0;")
+
+        if len(aStyle) > 0:
+            return " style='%s'" % (" ".join(aStyle))
+
+        return ""
+
     def _formatSynopsis(self, tText):
         """Apply HTML formatting to synopsis.
         """
-        if self.genMode == self.M_PREVIEW:
-            return "<p class='comment'><span class='synopsis'>Synopsis:</span> %s</p>\n" % tText
-        else:
-            return "<p class='synopsis'><strong>Synopsis:</strong> %s</p>\n" % tText
+        return self._tplSynopsis % tText
 
     def _formatComments(self, tText):
         """Apply HTML formatting to comments.
         """
-        if self.genMode == self.M_PREVIEW:
-            return "<p class='comment'>%s</p>\n" % tText
-        else:
-            return "<p class='comment'><strong>Comment:</strong> %s</p>\n" % tText
+        return self._tplComment % tText
 
     def _formatKeywords(self, tText):
         """Apply HTML formatting to keywords.
@@ -426,7 +495,6 @@ class ToHtml(Tokenizer):
             return ""
 
         retText = ""
-        refTags = []
         if theBits[0] in nwLabels.KEY_NAME:
             retText += "<span class='tags'>%s:</span> " % nwLabels.KEY_NAME[theBits[0]]
             if len(theBits) > 1:
@@ -434,19 +502,15 @@ class ToHtml(Tokenizer):
                     retText += "<a name='tag_%s'>%s</a>" % (
                         theBits[1], theBits[1]
                     )
+                elif self.genMode == self.M_PREVIEW:
+                    aKey = theBits[0][1:]
+                    retText += ", ".join(
+                        f"<a href='#{aKey}={tTag}'>{tTag}</a>" for tTag in theBits[1:]
+                    )
                 else:
-                    if self.genMode == self.M_PREVIEW:
-                        for tTag in theBits[1:]:
-                            refTags.append("<a href='#%s=%s'>%s</a>" % (
-                                theBits[0][1:], tTag, tTag
-                            ))
-                        retText += ", ".join(refTags)
-                    else:
-                        for tTag in theBits[1:]:
-                            refTags.append("<a href='#tag_%s'>%s</a>" % (
-                                tTag, tTag
-                            ))
-                        retText += ", ".join(refTags)
+                    retText += ", ".join(
+                        f"<a href='#tag_{tTag}'>{tTag}</a>" for tTag in theBits[1:]
+                    )
 
         return retText
 
@@ -141,6 +141,21 @@ class Tokenizer():
         # Error Handling
         self.errData = []
 
+        # The character translation map is static, so we only build it
+        # once instead of for every processed document
+        self._trMapChar = str.maketrans({nwUnicode.U_MAPOSS: nwUnicode.U_RSQUO})
+
+        # Likewise for the escaped character lookup and its pattern,
+        # used by doPostProcessing
+        self._escDict = {
+            r"\*" : "*",
+            r"\~" : "~",
+            r"\_" : "_",
+        }
+        self._rxEscapes = re.compile(
+            "|".join([re.escape(k) for k in self._escDict.keys()]), flags=re.DOTALL
+        )
+
         return
 
     ##
@@ -305,12 +320,13 @@ class Tokenizer():
             repDict = {}
             for aKey, aVal in self.theProject.autoReplace.items():
                 repDict["<%s>" % aKey] = aVal
-            xRep = re.compile("|".join([re.escape(k) for k in repDict.keys()]), flags=re.DOTALL)
+            xRep = re.compile("|".join([
+                re.escape(k) for k in sorted(repDict.keys(), key=len, reverse=True)
+            ]), flags=re.DOTALL)
             self.theText = xRep.sub(lambda x: repDict[x.group(0)], self.theText)
 
         # Process the character translation map
-        trDict = {nwUnicode.U_MAPOSS: nwUnicode.U_RSQUO}
-        self.theText = self.theText.translate(str.maketrans(trDict))
+        self.theText = self.theText.translate(self._trMapChar)
 
         return
 
@@ -318,16 +334,8 @@ class Tokenizer():
         """Do some postprocessing. Overloaded by subclasses. This just
         does the standard escaped characters.
         """
-        escapeDict = {
-            r"\*" : "*",
-            r"\~" : "~",
-            r"\_" : "_",
-        }
-        escReplace = re.compile(
-            "|".join([re.escape(k) for k in escapeDict.keys()]), flags=re.DOTALL
-        )
-        self.theResult = escReplace.sub(
-            lambda x: escapeDict[x.group(0)], self.theResult
+        self.theResult = self._rxEscapes.sub(
+            lambda x: self._escDict[x.group(0)], self.theResult
         )
         return
 